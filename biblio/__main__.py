@@ -3,15 +3,17 @@ from typing import IO
 from .services.semantic_scholar import ReferencesByPaper, Papers
 from .lang import Translations
 from .clusters import Clusters
-from .threat import ThreatScores
+from .threat import ThreatScores, ThreatCalibration
+from .citations import CitationGraph
 
 import pathlib
 
 from tqdm import tqdm
 import click
 
+import plotly.io
+import pydantic
 from plotly import graph_objects as go
-import matplotlib.colors
 import networkx as nx
 
 
@@ -22,11 +24,28 @@ from . import lang
 from . import clusters
 from . import threat
 from . import graph
+from . import citations
+from . import visualization
+from . import budget
+from . import artifacts
+from . import worker as biblio_worker
 
 
 @click.group(context_settings={"show_default": True})
-def cli():
-    pass
+@click.option(
+    "--max_tokens",
+    default=env.max_tokens,
+    type=int,
+    help="Maximum number of LLM tokens spent by the command",
+)
+@click.option(
+    "--max_cost",
+    default=env.max_cost,
+    type=float,
+    help="Maximum cost in USD of the LLM calls of the command",
+)
+def cli(*, max_tokens: int | None, max_cost: float | None):
+    budget.budget.reset(max_tokens=max_tokens, max_cost=max_cost)
 
 
 @cli.command()
@@ -47,13 +66,20 @@ def fetch_papers(*, query: str, limit: int, out: IO[str]):
     out.write(papers.model_dump_json(indent=2))
 
 
-@cli.command()
-@click.option("--papers_input", default=env.path.papers, type=click.File("r"))
-@click.option("--out", default=env.path.translations, type=click.File("w"))
-def generate_translations(*, papers_input: IO[str], out: IO[str]):
-    pathlib.Path(out.name).parent.mkdir(parents=True, exist_ok=True)
-
-    papers = Papers.model_validate_json(papers_input.read())
+def translate_papers(papers: Papers, max_abstract_tokens: int = 1000) -> Translations:
+    to_translate = [
+        (k, v)
+        for k, v in papers.papers.items()
+        if v.abstract and not lang.is_text_in_language(v.abstract, "en")
+    ]
+    budget.budget.check_estimates(
+        [
+            lang.estimate_translations(
+                [v for _, v in to_translate], max_abstract_tokens=max_abstract_tokens
+            )
+        ],
+        "Translating abstracts",
+    )
 
     translations = Translations(
         translations={
@@ -62,24 +88,80 @@ def generate_translations(*, papers_input: IO[str], out: IO[str]):
             if paper.abstract
         }
         | {
-            name: lang.translate_paper_to_en(paper)
-            for name, paper in tqdm(
-                [
-                    (k, v)
-                    for k, v in papers.papers.items()
-                    if v.abstract and not lang.is_text_in_language(v.abstract, "en")
-                ],
-                desc="Translating abstracts",
+            name: lang.translate_paper_to_en(
+                paper, max_abstract_tokens=max_abstract_tokens
             )
-            if paper.abstract
-            if not lang.is_text_in_language(paper.abstract, "en")
+            for name, paper in tqdm(to_translate, desc="Translating abstracts")
         }
     )
 
+    return translations
+
+
+@cli.command()
+@click.option("--papers_input", default=env.path.papers, type=click.File("r"))
+@click.option("--max_abstract_tokens", default=1000)
+@click.option("--out", default=env.path.translations, type=click.File("w"))
+def generate_translations(
+    *, papers_input: IO[str], max_abstract_tokens: int, out: IO[str]
+):
+    pathlib.Path(out.name).parent.mkdir(parents=True, exist_ok=True)
+
+    papers = Papers.model_validate_json(papers_input.read())
+    translations = translate_papers(papers, max_abstract_tokens=max_abstract_tokens)
+
     click.echo(f"Writing translations to {out.name}")
     out.write(translations.model_dump_json(indent=2))
 
 
+def fetch_all_references(
+    papers: Papers,
+    cache_folder: pathlib.Path = env.path.cache_folder,
+    cache: bool = True,
+    limit: int = 100,
+    batch: bool = False,
+    batch_size: int = 500,
+) -> ReferencesByPaper:
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    cache_file = (
+        cache_folder / hashlib.md5(papers.model_dump_json().encode()).hexdigest()
+    )
+    references = (
+        ReferencesByPaper.model_validate_json(cache_file.read_text())
+        if cache_file.exists() and cache
+        else ReferencesByPaper(papers={})
+    )
+
+    if batch:
+        missing = [name for name in papers.papers if name not in references.papers]
+        for i, (name, paper_references) in enumerate(
+            tqdm(
+                semantic_scholar.fetch_references_batch(
+                    missing, batch_size=batch_size, limit=limit
+                ),
+                total=len(missing),
+                desc="Fetching references in batches",
+            ),
+            start=1,
+        ):
+            references.papers[name] = paper_references
+            if i % batch_size == 0 or i == len(missing):
+                cache_file.write_text(references.model_dump_json(indent=2))
+
+    for name, paper in tqdm(papers.papers.items(), desc="Fetching references"):
+        # Without --batch, references cached by a --batch run are fetched again
+        if name in references.papers and (batch or references.papers[name].detailed):
+            continue
+
+        references.papers[name] = semantic_scholar.fetch_references(
+            paper_id=paper.paperId,
+            limit=limit,
+        )
+        cache_file.write_text(references.model_dump_json(indent=2))
+
+    return references
+
+
 @cli.command()
 @click.option("--papers_input", default=env.path.papers, type=click.File("r"))
 @click.option(
@@ -94,41 +176,47 @@ def generate_translations(*, papers_input: IO[str], out: IO[str]):
 )
 @click.option("--cache/--no-cache", default=True)
 @click.option("--limit", default=100)
+@click.option(
+    "--batch/--no-batch",
+    default=False,
+    help="Use the paper/batch endpoint, which does not return influential citations nor intents",
+)
+@click.option("--batch_size", default=500, type=click.IntRange(1, 500))
 @click.option("--out", default=env.path.references, type=click.File("w"))
+@click.option(
+    "--out_citations",
+    default=env.path.citations,
+    type=click.Path(file_okay=False, dir_okay=True, path_type=pathlib.Path),
+)
 def fetch_references(
     *,
     papers_input: IO[str],
     cache_folder: pathlib.Path,
     cache: bool,
     limit: int,
+    batch: bool,
+    batch_size: int,
     out: IO[str],
+    out_citations: pathlib.Path,
 ):
     pathlib.Path(out.name).parent.mkdir(parents=True, exist_ok=True)
     papers = Papers.model_validate_json(papers_input.read())
 
-    cache_folder.mkdir(parents=True, exist_ok=True)
-    cache_file = (
-        cache_folder / hashlib.md5(papers.model_dump_json().encode()).hexdigest()
-    )
-    references = (
-        ReferencesByPaper.model_validate_json(cache_file.read_text())
-        if cache_file.exists() and cache
-        else ReferencesByPaper(papers={})
+    references = fetch_all_references(
+        papers,
+        cache_folder=cache_folder,
+        cache=cache,
+        limit=limit,
+        batch=batch,
+        batch_size=batch_size,
     )
 
-    for name, paper in tqdm(papers.papers.items(), desc="Fetching references"):
-        if name in references.papers:
-            continue
-
-        references.papers[name] = semantic_scholar.fetch_references(
-            paper_id=paper.paperId,
-            limit=limit,
-        )
-        cache_file.write_text(references.model_dump_json(indent=2))
-
     click.echo(f"Writing references to {out.name}")
     out.write(references.model_dump_json(indent=2))
 
+    click.echo(f"Writing citation graph to {out_citations}")
+    citations.build_citation_graph(papers, references).save(out_citations)
+
 
 @cli.command()
 @click.option("--papers_input", default=env.path.papers, type=click.File("r"))
@@ -140,6 +228,12 @@ def fetch_references(
 @click.option("--n_dims", default=3)
 @click.option("--min_sample_size", default=10)
 @click.option("--min_samples", default=7)
+@click.option(
+    "--large_corpus/--no-large_corpus",
+    default=False,
+    help="Draw all clusters in a single WebGL trace with binary coordinates",
+)
+@click.option("--max_points", default=200_000, help="Used with --large_corpus")
 def generate_clusters(
     *,
     papers_input: IO[str],
@@ -149,6 +243,8 @@ def generate_clusters(
     min_sample_size: int,
     min_samples: int,
     n_dims: int,
+    large_corpus: bool,
+    max_points: int,
 ):
     pathlib.Path(out_json.name).parent.mkdir(parents=True, exist_ok=True)
     pathlib.Path(out_html.name).parent.mkdir(parents=True, exist_ok=True)
@@ -167,10 +263,159 @@ def generate_clusters(
     click.echo(f"Writing clusters to {out_json.name}")
     out_json.write(clusters_papers.model_dump_json(indent=2))
 
+    write_clusters_html(
+        clusters_papers, out_html, large_corpus=large_corpus, max_points=max_points
+    )
+
+
+@cli.command()
+@click.option("--papers_input", default=env.path.papers, type=click.File("r"))
+@click.option(
+    "--translations_input", default=env.path.translations, type=click.File("r")
+)
+@click.option("--out", default=env.path.cluster_sweep, type=click.File("w"))
+@click.option("--n_dims", default=3)
+@click.option("--min_sample_size", default=[5, 10, 15, 20, 30], multiple=True)
+@click.option("--min_samples", default=[3, 5, 7, 10], multiple=True)
+@click.option("--n_jobs", default=-1)
+@click.option(
+    "--validity/--no-validity",
+    default=True,
+    help="Rank settings by DBCV validity, computed on a sample of --validity_max_points points since its memory grows with the square of the cluster sizes. Persistence is used otherwise",
+)
+@click.option(
+    "--validity_max_points",
+    default=2000,
+    type=click.IntRange(min=2),
+    help="Used with --validity, larger samples are more accurate and use more memory in each of --n_jobs processes",
+)
+@click.option(
+    "--apply/--no-apply",
+    default=False,
+    help="Name the clusters of the best setting and write them like generate-clusters",
+)
+@click.option("--out_json", default=env.path.clusters, type=click.File("w", lazy=True))
+@click.option(
+    "--out_html", default=env.path.clusters_html, type=click.File("w", lazy=True)
+)
+@click.option(
+    "--large_corpus/--no-large_corpus",
+    default=False,
+    help="Used with --apply, see generate-clusters",
+)
+@click.option("--max_points", default=200_000, help="Used with --large_corpus")
+def sweep_clusters(
+    *,
+    papers_input: IO[str],
+    translations_input: IO[str],
+    out: IO[str],
+    n_dims: int,
+    min_sample_size: tuple[int, ...],
+    min_samples: tuple[int, ...],
+    n_jobs: int,
+    validity: bool,
+    validity_max_points: int,
+    apply: bool,
+    out_json: IO[str],
+    out_html: IO[str],
+    large_corpus: bool,
+    max_points: int,
+):
+    pathlib.Path(out.name).parent.mkdir(parents=True, exist_ok=True)
+
+    papers = Papers.model_validate_json(papers_input.read())
+    translations = Translations.model_validate_json(translations_input.read())
+
+    paper_ids, embeddings = clusters.embed_papers(papers, translations)
+    embeddings_tSNE = clusters.reduce_embeddings(embeddings, n_dims=n_dims)
+
+    sweep, labels = clusters.sweep_clusters(
+        embeddings_tSNE,
+        min_cluster_sizes=list(min_sample_size),
+        min_samples=list(min_samples),
+        n_jobs=n_jobs,
+        validity=validity,
+        validity_max_points=validity_max_points,
+    )
+
+    for setting in sweep.settings:
+        validity_score = "-" if setting.validity is None else f"{setting.validity:.3f}"
+        click.echo(
+            f"min_sample_size={setting.min_cluster_size:<4} "
+            f"min_samples={setting.min_samples:<4} "
+            f"clusters={setting.n_clusters:<4} "
+            f"noise={setting.noise_fraction:.2f} "
+            f"persistence={setting.persistence:.3f} "
+            f"validity={validity_score}"
+        )
+
+    best = sweep.best()
+    if best:
+        click.echo(
+            f"Best setting: --min_sample_size {best.min_cluster_size} --min_samples {best.min_samples}"
+        )
+    else:
+        click.echo("No setting produced at least 2 clusters")
+
+    click.echo(f"Writing cluster sweep to {out.name}")
+    out.write(sweep.model_dump_json(indent=2))
+
+    if not apply:
+        return
+
+    if not best:
+        raise click.ClickException("No setting to apply")
+
+    pathlib.Path(out_json.name).parent.mkdir(parents=True, exist_ok=True)
+    pathlib.Path(out_html.name).parent.mkdir(parents=True, exist_ok=True)
+
+    clusters_papers = clusters.build_clusters(
+        translations,
+        paper_ids,
+        embeddings,
+        embeddings_tSNE,
+        labels[best.min_cluster_size, best.min_samples],
+    )
+
+    click.echo(f"Writing clusters to {out_json.name}")
+    out_json.write(clusters_papers.model_dump_json(indent=2))
+
+    write_clusters_html(
+        clusters_papers, out_html, large_corpus=large_corpus, max_points=max_points
+    )
+
+
+def write_clusters_html_file(
+    clusters_papers: Clusters,
+    path: pathlib.Path,
+    large_corpus: bool = False,
+    max_points: int = 200_000,
+):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as out_html:
+        write_clusters_html(
+            clusters_papers, out_html, large_corpus=large_corpus, max_points=max_points
+        )
+
+
+def write_clusters_html(
+    clusters_papers: Clusters,
+    out_html: IO[str],
+    large_corpus: bool = False,
+    max_points: int = 200_000,
+):
     click.echo(f"Writing interactive clusters to {out_html.name}")
 
+    if large_corpus:
+        plotly.io.write_html(
+            visualization.large_clusters_figure(clusters_papers, max_points),
+            out_html,
+            validate=False,
+        )
+        return
+
     fig = go.Figure()
-    colors = iter(matplotlib.colors.cnames.values())
+    colors = visualization.generate_colors()
     for cluster in clusters_papers.clusters.values():
         if cluster.index == -1:
             continue
@@ -193,30 +438,160 @@ def generate_clusters(
     fig.write_html(out_html)
 
 
+def score_threats(
+    clusters: Clusters,
+    method: str = "local",
+    calibration_sample_size: int = 0,
+    calibration: pathlib.Path = env.path.threat_calibration,
+) -> ThreatScores:
+    if method == "llm":
+        budget.budget.check_estimates(
+            [threat.estimate_threat_scores(i.name for i in clusters.clusters.values())],
+            "Evaluating threat scores",
+        )
+        scores = ThreatScores(
+            threat_scores={
+                i: threat.threat_score(j.name)
+                for i, j in tqdm(
+                    clusters.clusters.items(), desc="Evaluating threat scores"
+                )
+            }
+        )
+    else:
+        if calibration_sample_size > 0:
+            threat_calibration = threat.calibrate(
+                clusters, sample_size=calibration_sample_size
+            )
+            click.echo(f"Writing threat calibration to {calibration}")
+            calibration.parent.mkdir(parents=True, exist_ok=True)
+            calibration.write_text(threat_calibration.model_dump_json(indent=2))
+        elif calibration.exists():
+            threat_calibration = ThreatCalibration.model_validate_json(
+                calibration.read_text()
+            )
+        else:
+            click.echo(
+                f"Warning: no threat calibration in {calibration}, scores use an "
+                "uncalibrated mapping, see --calibration_sample_size",
+                err=True,
+            )
+            threat_calibration = ThreatCalibration()
+
+        click.echo("Evaluating threat scores")
+        scores = threat.local_threat_scores(clusters, calibration=threat_calibration)
+
+    return scores
+
+
 @cli.command()
 @click.option("--clusters_input", default=env.path.clusters, type=click.File("r"))
+@click.option("--method", default="local", type=click.Choice(["local", "llm"]))
+@click.option(
+    "--calibration_sample_size",
+    default=0,
+    help="Number of clusters scored by the LLM to calibrate local scores, at least 5, 0 reuses the saved calibration",
+)
+@click.option(
+    "--calibration",
+    default=env.path.threat_calibration,
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+)
 @click.option("--out", default=env.path.threat_scores, type=click.File("w"))
 def generate_threat_scores(
     *,
     clusters_input: IO[str],
+    method: str,
+    calibration_sample_size: int,
+    calibration: pathlib.Path,
     out: IO[str],
 ):
     pathlib.Path(out.name).parent.mkdir(parents=True, exist_ok=True)
     clusters = Clusters.model_validate_json(clusters_input.read())
 
-    scores = ThreatScores(
-        threat_scores={
-            i: threat.threat_score(j.name)
-            for i, j in tqdm(clusters.clusters.items(), desc="Evaluating threat scores")
-        }
+    scores = score_threats(
+        clusters,
+        method=method,
+        calibration_sample_size=calibration_sample_size,
+        calibration=calibration,
     )
 
     out.write(scores.model_dump_json(indent=2))
 
 
+def compute_citation_analytics(
+    citation_graph: CitationGraph, clusters: Clusters
+) -> citations.CitationAnalytics:
+    click.echo("Computing citation analytics...")
+    analytics = citations.CitationAnalytics(
+        pagerank=citations.pagerank(citation_graph),
+        cluster_density=citations.cluster_citation_density(citation_graph, clusters),
+    )
+
+    return analytics
+
+
 @cli.command()
-@click.option("--papers_input", default=env.path.papers, type=click.File("r"))
-@click.option("--references_input", default=env.path.references, type=click.File("r"))
+@click.option(
+    "--citations_input",
+    default=env.path.citations,
+    type=click.Path(
+        exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path
+    ),
+)
+@click.option("--clusters_input", default=env.path.clusters, type=click.File("r"))
+@click.option("--out", default=env.path.citation_analytics, type=click.File("w"))
+def generate_citation_analytics(
+    *,
+    citations_input: pathlib.Path,
+    clusters_input: IO[str],
+    out: IO[str],
+):
+    pathlib.Path(out.name).parent.mkdir(parents=True, exist_ok=True)
+
+    citation_graph = CitationGraph.load(citations_input)
+    clusters = Clusters.model_validate_json(clusters_input.read())
+
+    analytics = compute_citation_analytics(citation_graph, clusters)
+
+    click.echo(f"Writing citation analytics to {out.name}")
+    out.write(analytics.model_dump_json(indent=2))
+
+
+def draw_graph(
+    citation_graph: CitationGraph,
+    clusters: Clusters,
+    threat: ThreatScores,
+    out: IO[bytes],
+    threshold_threat_color: float = 0.75,
+    remove_isolated_nodes: bool = True,
+    influence_weight: float = 1.0 / 8,
+):
+    click.echo("Generating graph...")
+    todraw = graph.generate_graph(
+        citations=citation_graph,
+        clusters=clusters,
+        threats=threat,
+        threshold_threat_color=threshold_threat_color,
+        remove_isolated_nodes=remove_isolated_nodes,
+        influence_weight=influence_weight,
+    )
+    graphviz = nx.nx_agraph.to_agraph(todraw)
+
+    graphviz.graph_attr.update()
+    graphviz.node_attr.update(fontsize=40, fontfamily="FreeMono", fontweight="bold")
+    graphviz.edge_attr.update(dir="back")
+    click.echo(f"Writing graph to {out.name}")
+    graphviz.draw(out, prog="dot")
+
+
+@cli.command()
+@click.option(
+    "--citations_input",
+    default=env.path.citations,
+    type=click.Path(
+        exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path
+    ),
+)
 @click.option("--clusters_input", default=env.path.clusters, type=click.File("r"))
 @click.option("--threat_input", default=env.path.threat_scores, type=click.File("r"))
 @click.option("--threshold_threat_color", default=0.75)
@@ -227,8 +602,7 @@ def generate_threat_scores(
 @click.option("--out", default=env.path.graph, type=click.File("wb"))
 def generate_graph(
     *,
-    papers_input: IO[str],
-    references_input: IO[str],
+    citations_input: pathlib.Path,
     clusters_input: IO[str],
     threat_input: IO[str],
     threshold_threat_color: float,
@@ -238,36 +612,148 @@ def generate_graph(
 ):
     pathlib.Path(out.name).parent.mkdir(parents=True, exist_ok=True)
 
-    papers = Papers.model_validate_json(papers_input.read())
-    references = ReferencesByPaper.model_validate_json(references_input.read())
+    citation_graph = CitationGraph.load(citations_input)
     clusters = Clusters.model_validate_json(clusters_input.read())
     threat = ThreatScores.model_validate_json(threat_input.read())
 
-    click.echo("Generating graph...")
-    todraw = graph.generate_graph(
-        papers=papers,
-        references_by_papers=references,
-        clusters=clusters,
-        threats=threat,
+    draw_graph(
+        citation_graph,
+        clusters,
+        threat,
+        out,
         threshold_threat_color=threshold_threat_color,
         remove_isolated_nodes=remove_isolated_nodes,
         influence_weight=influence_weight,
     )
-    graphviz = nx.nx_agraph.to_agraph(todraw)
 
-    graphviz.graph_attr.update()
-    graphviz.node_attr.update(fontsize=40, fontfamily="FreeMono", fontweight="bold")
-    graphviz.edge_attr.update(dir="back")
-    click.echo(f"Writing graph to {out.name}")
-    graphviz.draw(out, prog="dot")
+
+@cli.command()
+def worker():
+    """
+    Keep models and clients loaded, other biblio commands run here while it is up
+    """
+    biblio_worker.serve(cli, env.path.worker_socket)
 
 
 @cli.command()
-@click.pass_context
-def pipeline(ctx: click.Context):
-    ctx.invoke(fetch_papers)
-    ctx.invoke(generate_translations)
-    ctx.invoke(generate_clusters)
-    ctx.invoke(generate_threat_scores)
-    ctx.invoke(fetch_references)
-    ctx.invoke(generate_graph)
+@click.option(
+    "--persist_intermediate/--no-persist_intermediate",
+    default=True,
+    help="Also write papers, translations, clusters, threat scores, references and citations",
+)
+@click.option("--query", default="bioterrorism")
+@click.option("--limit", default=100)
+@click.option("--max_abstract_tokens", default=1000)
+@click.option("--n_dims", default=3)
+@click.option("--min_sample_size", default=10)
+@click.option("--min_samples", default=7)
+@click.option(
+    "--large_corpus/--no-large_corpus",
+    default=False,
+    help="Draw all clusters in a single WebGL trace with binary coordinates",
+)
+@click.option("--max_points", default=200_000, help="Used with --large_corpus")
+@click.option("--method", default="local", type=click.Choice(["local", "llm"]))
+@click.option(
+    "--calibration_sample_size",
+    default=0,
+    help="Number of clusters scored by the LLM to calibrate local scores, at least 5, 0 reuses the saved calibration",
+)
+@click.option("--references_limit", default=100, help="--limit of fetch-references")
+@click.option(
+    "--batch/--no-batch",
+    default=False,
+    help="Use the paper/batch endpoint, which does not return influential citations nor intents",
+)
+@click.option("--batch_size", default=500, type=click.IntRange(1, 500))
+@click.option("--threshold_threat_color", default=0.75)
+@click.option(
+    "--remove_isolated_nodes/--no-remove_isolated_nodes", default=True, is_flag=True
+)
+@click.option("--influence_weight", default=1.0 / 8)
+def pipeline(
+    *,
+    persist_intermediate: bool,
+    query: str,
+    limit: int,
+    max_abstract_tokens: int,
+    n_dims: int,
+    min_sample_size: int,
+    min_samples: int,
+    large_corpus: bool,
+    max_points: int,
+    method: str,
+    calibration_sample_size: int,
+    references_limit: int,
+    batch: bool,
+    batch_size: int,
+    threshold_threat_color: float,
+    remove_isolated_nodes: bool,
+    influence_weight: float,
+):
+    """
+    Run all stages, passing their results in memory. Files are written in the background.
+    Options are the ones of the commands of each stage
+    """
+    with artifacts.ArtifactWriter() as writer:
+
+        def persist(path: pathlib.Path, artifact: pydantic.BaseModel):
+            if persist_intermediate:
+                writer.write_json(path, artifact)
+
+        click.echo(f"Fetching papers for {query}...")
+        papers = semantic_scholar.fetch_papers(query=query, limit=limit)
+        persist(env.path.papers, papers)
+
+        translations = translate_papers(papers, max_abstract_tokens=max_abstract_tokens)
+        persist(env.path.translations, translations)
+
+        clusters_papers = clusters.cluster_papers(
+            papers,
+            translations,
+            min_cluster_size=min_sample_size,
+            min_samples=min_samples,
+            n_dims=n_dims,
+        )
+        persist(env.path.clusters, clusters_papers)
+        writer.submit(
+            write_clusters_html_file,
+            clusters_papers,
+            env.path.clusters_html,
+            large_corpus,
+            max_points,
+        )
+
+        scores = score_threats(
+            clusters_papers,
+            method=method,
+            calibration_sample_size=calibration_sample_size,
+        )
+        persist(env.path.threat_scores, scores)
+
+        references = fetch_all_references(
+            papers, limit=references_limit, batch=batch, batch_size=batch_size
+        )
+        persist(env.path.references, references)
+
+        citation_graph = citations.build_citation_graph(papers, references)
+        if persist_intermediate:
+            click.echo(f"Writing citation graph to {env.path.citations}")
+            writer.submit(citation_graph.save, env.path.citations)
+
+        env.path.graph.parent.mkdir(parents=True, exist_ok=True)
+        with env.path.graph.open("wb") as out:
+            draw_graph(
+                citation_graph,
+                clusters_papers,
+                scores,
+                out,
+                threshold_threat_color=threshold_threat_color,
+                remove_isolated_nodes=remove_isolated_nodes,
+                influence_weight=influence_weight,
+            )
+
+        writer.write_json(
+            env.path.citation_analytics,
+            compute_citation_analytics(citation_graph, clusters_papers),
+        )
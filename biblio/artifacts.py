@@ -0,0 +1,53 @@
+import concurrent.futures
+import pathlib
+from typing import Any, Callable
+
+import click
+import pydantic
+
+
+class ArtifactWriter:
+    """
+    Persists artifacts from a background thread, so that the next stage does not wait
+    for serialization and disk. Writes happen in submission order, and leaving the
+    context waits for all of them and raises the first error, unless the context is
+    left with an error already.
+
+    Artifacts must not be modified after being submitted.
+    """
+
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._futures: list[concurrent.futures.Future[None]] = []
+
+    def submit(self, function: Callable[..., Any], *args: Any):
+        self._futures.append(self._executor.submit(function, *args))
+
+    def write_json(self, path: pathlib.Path, artifact: pydantic.BaseModel):
+        def write():
+            click.echo(f"Writing {path}")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(artifact.model_dump_json(indent=2))
+
+        self.submit(write)
+
+    def wait(self):
+        try:
+            for future in concurrent.futures.as_completed(self._futures):
+                future.result()
+        finally:
+            self._futures = []
+
+    def __enter__(self) -> "ArtifactWriter":
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *exc_info: Any):
+        try:
+            self.wait()
+        except Exception as e:
+            # Do not replace the error of the stage that left the context
+            if exc_type is None:
+                raise
+            click.echo(f"Error: Writing artifacts failed too: {e}", err=True)
+        finally:
+            self._executor.shutdown()
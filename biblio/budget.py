@@ -0,0 +1,188 @@
+import re
+from typing import Iterable, Iterator
+
+import click
+import nltk
+import pydantic
+
+try:
+    import tiktoken
+except ImportError:  # Falls back to ~4 characters per token, too few for CJK text
+    tiktoken = None
+
+nltk.download("punkt")
+
+# USD per 1000 tokens, (prompt, completion)
+PRICES: dict[str, tuple[float, float]] = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4o": (0.005, 0.015),
+}
+
+# Tokens added by the chat format around each message
+MESSAGE_OVERHEAD = 7
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+
+    return len(tiktoken.encoding_for_model(model).encode(text))
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = PRICES[model]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def _split(text: str, max_tokens: int, model: str) -> list[str]:
+    """
+    Consecutive pieces of text of about max_tokens tokens
+    """
+    if tiktoken is None:
+        size = max_tokens * 4
+        return [text[i : i + size] for i in range(0, len(text), size)]
+
+    encoding = tiktoken.encoding_for_model(model)
+    _, offsets = encoding.decode_with_offsets(encoding.encode(text))
+    offsets.append(len(text))
+
+    pieces = []
+    start = 0
+    while start < len(offsets) - 1:
+        end = min(start + max_tokens, len(offsets) - 1)
+        # Tokens with the same offset are bytes of one character, never split
+        while end > start + 1 and offsets[end] == offsets[end - 1]:
+            end -= 1
+        pieces.append(text[offsets[start] : offsets[end]])
+        start = end
+
+    return [i for i in pieces if i]
+
+
+def _sentences(text: str) -> Iterator[str]:
+    # Punkt does not split on CJK sentence ends
+    for sentence in nltk.sent_tokenize(text):
+        yield from (i for i in re.split(r"(?<=[。！？])", sentence) if i)
+
+
+def chunk_sentences(
+    text: str, max_tokens: int, model: str = "gpt-3.5-turbo"
+) -> list[str]:
+    """
+    Split text on sentence boundaries into chunks of at most max_tokens tokens.
+    A single sentence longer than max_tokens is split into several chunks
+    """
+    chunks: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+    pieces = (
+        piece
+        for sentence in _sentences(text)
+        for piece in (
+            [sentence]
+            if count_tokens(sentence, model) <= max_tokens
+            else _split(sentence, max_tokens, model)
+        )
+    )
+    for sentence in pieces:
+        tokens = count_tokens(sentence, model)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+
+        current.append(sentence)
+        current_tokens += tokens
+
+    if current:
+        chunks.append(" ".join(current))
+
+    return chunks
+
+
+def trim_lines(
+    lines: Iterable[str], max_tokens: int, model: str = "gpt-3.5-turbo"
+) -> list[str]:
+    """
+    First lines fitting in max_tokens tokens
+    """
+    result = []
+    total = 0
+    for line in lines:
+        total += count_tokens(line, model) + 1
+        if total > max_tokens:
+            break
+        result.append(line)
+
+    return result
+
+
+class Estimate(pydantic.BaseModel):
+    model: str
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def add(self, prompt: str, max_completion_tokens: int):
+        self.calls += 1
+        self.prompt_tokens += count_tokens(prompt, self.model) + MESSAGE_OVERHEAD
+        self.completion_tokens += max_completion_tokens
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def cost(self) -> float:
+        return cost(self.model, self.prompt_tokens, self.completion_tokens)
+
+
+class BudgetExceededError(click.ClickException):
+    pass
+
+
+class TokenBudget(pydantic.BaseModel):
+    """
+    Tokens and cost spent by all LLM calls of the process, limited by max_tokens
+    and max_cost when they are set
+    """
+
+    max_tokens: int | None = None
+    max_cost: float | None = None
+    tokens: int = 0
+    spent: float = 0.0
+
+    def reset(self, max_tokens: int | None, max_cost: float | None):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.tokens = 0
+        self.spent = 0.0
+
+    def check(self, tokens: int, cost: float, description: str):
+        if self.max_tokens is not None and self.tokens + tokens > self.max_tokens:
+            raise BudgetExceededError(
+                f"{description} needs {tokens} tokens, "
+                f"{self.max_tokens - self.tokens} are left in the budget"
+            )
+        if self.max_cost is not None and self.spent + cost > self.max_cost:
+            raise BudgetExceededError(
+                f"{description} costs ${cost:.4f}, "
+                f"${self.max_cost - self.spent:.4f} are left in the budget"
+            )
+
+    def check_estimates(self, estimates: Iterable[Estimate], description: str):
+        estimates = list(estimates)
+        tokens = sum(i.tokens for i in estimates)
+        total_cost = sum(i.cost for i in estimates)
+        click.echo(
+            f"{description}: {sum(i.calls for i in estimates)} LLM calls, "
+            f"~{tokens} tokens, ~${total_cost:.4f}"
+        )
+        self.check(tokens, total_cost, description)
+
+    def charge(self, model: str, prompt_tokens: int, completion_tokens: int):
+        self.tokens += prompt_tokens + completion_tokens
+        self.spent += cost(model, prompt_tokens, completion_tokens)
+
+
+budget = TokenBudget()
@@ -0,0 +1,183 @@
+import dataclasses
+import json
+import pathlib
+
+import numpy as np
+import numpy.typing as npt
+import pydantic
+
+from .services.semantic_scholar import PaperID, Papers, ReferencesByPaper
+from .clusters import Clusters, ClusterID
+
+
+# Bit assigned to each Semantic Scholar citation intent in CitationGraph.intents
+INTENTS = ("background", "methodology", "result")
+
+
+@dataclasses.dataclass(frozen=True)
+class CitationGraph:
+    """
+    Citations between papers of the corpus stored as a CSR adjacency.
+
+    Paper i cites papers indices[indptr[i]:indptr[i + 1]]. Edge flags are
+    stored per edge in the same order: influential is a packed bitmask and
+    intents holds one bit per entry of INTENTS.
+    """
+
+    paper_ids: list[PaperID]
+    indptr: npt.NDArray[np.int64]
+    indices: npt.NDArray[np.int32]
+    influential: npt.NDArray[np.uint8]
+    intents: npt.NDArray[np.uint8]
+
+    @property
+    def n_papers(self) -> int:
+        return len(self.paper_ids)
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.indices)
+
+    @property
+    def sources(self) -> npt.NDArray[np.int64]:
+        return np.repeat(np.arange(self.n_papers), np.diff(self.indptr))
+
+    @property
+    def is_influential(self) -> npt.NDArray[np.bool_]:
+        return np.unpackbits(self.influential, count=self.n_edges).astype(bool)
+
+    def has_intent(self, intent: str) -> npt.NDArray[np.bool_]:
+        return (self.intents & (1 << INTENTS.index(intent))) != 0
+
+    def index_by_paper(self) -> dict[PaperID, int]:
+        return {paper_id: i for i, paper_id in enumerate(self.paper_ids)}
+
+    def save(self, folder: pathlib.Path):
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / "papers.json").write_text(json.dumps(self.paper_ids))
+        for field in ("indptr", "indices", "influential", "intents"):
+            np.save(folder / f"{field}.npy", getattr(self, field))
+
+    @classmethod
+    def load(cls, folder: pathlib.Path, mmap: bool = True) -> "CitationGraph":
+        mmap_mode = "r" if mmap else None
+        return cls(
+            paper_ids=json.loads((folder / "papers.json").read_text()),
+            indptr=np.load(folder / "indptr.npy", mmap_mode=mmap_mode),
+            indices=np.load(folder / "indices.npy", mmap_mode=mmap_mode),
+            influential=np.load(folder / "influential.npy", mmap_mode=mmap_mode),
+            intents=np.load(folder / "intents.npy", mmap_mode=mmap_mode),
+        )
+
+
+def build_citation_graph(
+    papers: Papers, references: ReferencesByPaper
+) -> CitationGraph:
+    """
+    Build the CSR adjacency, only keeping citations between two papers of papers
+    """
+    paper_ids = list(papers.papers)
+    index_by_paper = {paper_id: i for i, paper_id in enumerate(paper_ids)}
+
+    indptr = [0]
+    indices: list[int] = []
+    influential: list[bool] = []
+    intents: list[int] = []
+
+    for paper_id in paper_ids:
+        links = references.papers.get(paper_id)
+        for link in links.references if links else []:
+            trg = index_by_paper.get(link.citedPaper.paperId or "")
+            if trg is None:
+                continue
+
+            indices.append(trg)
+            influential.append(link.isInfluential)
+            intents.append(
+                sum(1 << INTENTS.index(i) for i in set(link.intents) if i in INTENTS)
+            )
+        indptr.append(len(indices))
+
+    return CitationGraph(
+        paper_ids=paper_ids,
+        indptr=np.array(indptr, dtype=np.int64),
+        indices=np.array(indices, dtype=np.int32),
+        influential=np.packbits(np.array(influential, dtype=bool)),
+        intents=np.array(intents, dtype=np.uint8),
+    )
+
+
+def get_cluster_labels(
+    citations: CitationGraph, clusters: Clusters
+) -> npt.NDArray[np.int64]:
+    """
+    Cluster of every paper of citations, -1 for noise and papers without cluster
+    """
+    index_by_paper = citations.index_by_paper()
+    labels = np.full(citations.n_papers, -1, dtype=np.int64)
+    for cluster in clusters.clusters.values():
+        for point in cluster.points:
+            if point.paper_id in index_by_paper:
+                labels[index_by_paper[point.paper_id]] = cluster.index
+
+    return labels
+
+
+def pagerank(
+    citations: CitationGraph,
+    damping: float = 0.85,
+    max_iter: int = 100,
+    tol: float = 1e-10,
+) -> dict[PaperID, float]:
+    n = citations.n_papers
+    if n == 0:
+        return {}
+
+    sources = citations.sources
+    out_degree = np.diff(citations.indptr).astype(np.float64)
+    dangling = out_degree == 0
+    weights = 1.0 / out_degree[sources]
+
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        spread = np.bincount(
+            citations.indices, weights=rank[sources] * weights, minlength=n
+        )
+        new_rank = (1.0 - damping) / n + damping * (spread + rank[dangling].sum() / n)
+        converged = np.abs(new_rank - rank).sum() < tol
+        rank = new_rank
+        if converged:
+            break
+
+    return dict(zip(citations.paper_ids, rank.tolist()))
+
+
+def cluster_citation_density(
+    citations: CitationGraph, clusters: Clusters
+) -> dict[ClusterID, float]:
+    """
+    Fraction of the possible citations inside each cluster that actually exist
+    """
+    labels = get_cluster_labels(citations, clusters)
+    src_labels = labels[citations.sources]
+    trg_labels = labels[citations.indices]
+    internal = (src_labels == trg_labels) & (src_labels != -1)
+
+    sizes = {int(k): int(v) for k, v in zip(*np.unique(labels, return_counts=True))}
+    edges = {
+        int(k): int(v)
+        for k, v in zip(*np.unique(src_labels[internal], return_counts=True))
+    }
+
+    return {
+        cluster: edges.get(cluster, 0) / (sizes[cluster] * (sizes[cluster] - 1))
+        if sizes.get(cluster, 0) > 1
+        else 0.0
+        for cluster in clusters.clusters
+        if cluster != -1
+    }
+
+
+class CitationAnalytics(pydantic.BaseModel):
+    pagerank: dict[PaperID, float]
+    cluster_density: dict[ClusterID, float]
@@ -2,27 +2,39 @@ from .services.semantic_scholar import PaperID, Papers
 from .lang import Translations
 
 from collections import defaultdict
+import functools
 import click
 from tqdm import tqdm
-from .services.openai import client
+from .services.openai import chat
+from .budget import budget, Estimate, trim_lines
 
 import pydantic
 
+import tempfile
+
+import joblib
+import numpy as np
+import numpy.typing as npt
 from sklearn.manifold import TSNE
 import hdbscan
+import hdbscan.validity
 
 from sentence_transformers import SentenceTransformer
 
 
 ClusterID = int
 
+EMBEDDING_MODEL = "all-mpnet-base-v2"
+CLUSTER_TITLE_MODEL = "gpt-3.5-turbo"
+CLUSTER_TITLE_MAX_TOKENS = 32
+
 
 class Clusters(pydantic.BaseModel):
     class Cluster(pydantic.BaseModel):
         class Point(pydantic.BaseModel):
             paper_id: PaperID
             embedding: tuple[float, ...]
-            tsne: tuple[float, float, float]
+            tsne: tuple[float, ...]
             index: int
 
         index: int
@@ -32,16 +44,31 @@ class Clusters(pydantic.BaseModel):
     clusters: dict[ClusterID, Cluster] = {}
 
 
-def generate_cluster_title(
+@functools.cache
+def get_embedder() -> SentenceTransformer:
+    """
+    Loaded once per process, so that the worker keeps it in memory between commands
+    """
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+
+def cluster_title_prompt(
     translations: Translations,
     cluster: Clusters.Cluster,
     limit: int = 20,
+    max_titles_tokens: int = 600,
 ) -> str:
     def get_title(paper_id: PaperID) -> str:
         return translations.translations[paper_id].title
 
-    titles = "\n".join(get_title(point.paper_id) for point in cluster.points[:limit])
-    prompt = f"""
+    titles = "\n".join(
+        trim_lines(
+            (get_title(point.paper_id) for point in cluster.points[:limit]),
+            max_titles_tokens,
+            CLUSTER_TITLE_MODEL,
+        )
+    )
+    return f"""
         Based on the following titles of research papers, generate a concise and informative title for a research axis that encapsulates the common theme. The title should be succinct, informative, and consist of 3 to 10 words. Do not use a colon (:). Here are some examples of good research axis titles:
 
         - Integrated Syndromic Surveillance for Enhanced Public Health Preparedness
@@ -54,26 +81,32 @@ def generate_cluster_title(
 
         Generate a research axis title:
         """
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=32,
+
+
+def generate_cluster_title(
+    translations: Translations,
+    cluster: Clusters.Cluster,
+    limit: int = 20,
+) -> str:
+    response = chat(
+        cluster_title_prompt(translations, cluster, limit),
+        model=CLUSTER_TITLE_MODEL,
+        max_tokens=CLUSTER_TITLE_MAX_TOKENS,
         temperature=0.0,
         stop=["\n"],
         logit_bias={"25": -20, "1058": -20},
     )
 
-    assert response.choices[0].message.content
-    return response.choices[0].message.content
+    assert response
+    return response
 
 
-def cluster_papers(
-    papers: Papers,
-    translations: Translations,
-    n_dims: int = 3,
-    min_cluster_size: int = 10,
-    min_samples: int = 7,
-) -> Clusters:
+def embed_papers(
+    papers: Papers, translations: Translations
+) -> tuple[list[PaperID], npt.NDArray[np.float32]]:
+    """
+    Embeddings of the abstracts of all papers having a translation
+    """
     papers = Papers(
         papers={
             i: j for i, j in papers.papers.items() if i in translations.translations
@@ -86,26 +119,36 @@ def cluster_papers(
     abstracts = [get_abstract(paper) for paper in papers.papers.values()]
 
     click.echo("Computing embeddings of abstracts")
-    embedder = SentenceTransformer("all-mpnet-base-v2")
-    embeddings = embedder.encode(
+    embeddings = get_embedder().encode(
         abstracts,
         show_progress_bar=True,
     )
 
+    return list(papers.papers), np.asarray(embeddings)
+
+
+def reduce_embeddings(
+    embeddings: npt.NDArray[np.float32], n_dims: int = 3
+) -> npt.NDArray[np.float32]:
     click.echo("Computing t-SNE of embeddings")
     tsne = TSNE(n_components=n_dims, random_state=0, verbose=1)
-    embeddings_tSNE = tsne.fit_transform(embeddings)  # type: ignore
+    return tsne.fit_transform(embeddings)  # type: ignore
 
-    click.echo("Computing hdbscan of t-SNE embeddings")
-    clusterer = hdbscan.HDBSCAN(
-        min_cluster_size=min_cluster_size, min_samples=min_samples
-    )
-    labels = clusterer.fit_predict(embeddings_tSNE)
 
+def build_clusters(
+    translations: Translations,
+    paper_ids: list[PaperID],
+    embeddings: npt.NDArray[np.float32],
+    embeddings_tSNE: npt.NDArray[np.float32],
+    labels: npt.NDArray[np.int64],
+) -> Clusters:
+    """
+    Group papers by hdbscan label and generate a title for each cluster
+    """
     result_raw = defaultdict(list[Clusters.Cluster.Point])
 
     for index, (label, paper_id, embedding, tsne) in list(
-        enumerate(zip(labels, papers.papers, embeddings, embeddings_tSNE))
+        enumerate(zip(labels, paper_ids, embeddings, embeddings_tSNE))
     ):
         result_raw[int(label)].append(
             Clusters.Cluster.Point(
@@ -116,15 +159,168 @@ def cluster_papers(
             )
         )
 
-    result = Clusters()
-    for label, cluster in tqdm(
-        list(result_raw.items()), desc="Generating cluster titles"
-    ):
-        cluster = Clusters.Cluster(points=cluster, name="", index=label)
-        cluster.name = (
-            generate_cluster_title(translations, cluster) if label != -1 else "Noise"
+    result = Clusters(
+        clusters={
+            label: Clusters.Cluster(points=points, name="Noise", index=label)
+            for label, points in result_raw.items()
+        }
+    )
+    named = [i for i in result.clusters.values() if i.index != -1]
+
+    estimate = Estimate(model=CLUSTER_TITLE_MODEL)
+    for cluster in named:
+        estimate.add(
+            cluster_title_prompt(translations, cluster), CLUSTER_TITLE_MAX_TOKENS
+        )
+    budget.check_estimates([estimate], "Generating cluster titles")
+
+    for cluster in tqdm(named, desc="Generating cluster titles"):
+        cluster.name = generate_cluster_title(translations, cluster)
+
+    return result
+
+
+def cluster_papers(
+    papers: Papers,
+    translations: Translations,
+    n_dims: int = 3,
+    min_cluster_size: int = 10,
+    min_samples: int = 7,
+) -> Clusters:
+    paper_ids, embeddings = embed_papers(papers, translations)
+    embeddings_tSNE = reduce_embeddings(embeddings, n_dims=n_dims)
+
+    click.echo("Computing hdbscan of t-SNE embeddings")
+    clusterer = hdbscan.HDBSCAN(
+        min_cluster_size=min_cluster_size, min_samples=min_samples
+    )
+    labels = clusterer.fit_predict(embeddings_tSNE)
+
+    return build_clusters(translations, paper_ids, embeddings, embeddings_tSNE, labels)
+
+
+class ClusterSweep(pydantic.BaseModel):
+    class Setting(pydantic.BaseModel):
+        min_cluster_size: int
+        min_samples: int
+        n_clusters: int
+        noise_fraction: float
+        persistence: float
+        validity: float | None = None
+
+    # Settings are ranked by validity when it is computed, by persistence otherwise
+    validity: bool = True
+    settings: list[Setting] = []
+
+    def best(self) -> Setting | None:
+        """
+        With validity, settings with less than 2 clusters have no validity and are
+        never the best one. None when no setting can be ranked
+        """
+        if not self.validity:
+            return max(self.settings, key=lambda i: i.persistence, default=None)
+
+        return max(
+            (i for i in self.settings if i.validity is not None),
+            key=lambda i: i.validity or 0.0,
+            default=None,
         )
 
-        result.clusters[label] = cluster
+
+def _validity(
+    embeddings_tSNE: npt.NDArray[np.float32],
+    labels: npt.NDArray[np.int64],
+    max_points: int,
+) -> float | None:
+    """
+    DBCV validity index on a random sample of at most max_points points, since it
+    builds a dense distance matrix for each cluster. None with less than 2 clusters
+    """
+    if len(labels) > max_points:
+        kept = np.random.default_rng(0).choice(len(labels), max_points, replace=False)
+        embeddings_tSNE, labels = embeddings_tSNE[kept], labels[kept]
+
+    # Clusters with a single sampled point break validity_index, count them as noise
+    clusters, counts = np.unique(labels[labels != -1], return_counts=True)
+    labels = np.where(np.isin(labels, clusters[counts < 2]), -1, labels)
+    if len(clusters[counts >= 2]) < 2:
+        return None
+
+    return float(
+        hdbscan.validity.validity_index(embeddings_tSNE.astype(np.float64), labels)
+    )
+
+
+def _sweep_min_samples(
+    embeddings_tSNE: npt.NDArray[np.float32],
+    min_samples: int,
+    min_cluster_sizes: list[int],
+    memory: joblib.Memory,
+    validity: bool,
+    validity_max_points: int,
+) -> list[tuple[ClusterSweep.Setting, npt.NDArray[np.int64]]]:
+    """
+    Every min_cluster_size shares the same min_samples, so the hierarchy computed
+    by the first fit is cached in memory and reused by the following ones
+    """
+    result = []
+    for min_cluster_size in min_cluster_sizes:
+        clusterer = hdbscan.HDBSCAN(
+            min_cluster_size=min_cluster_size,
+            min_samples=min_samples,
+            memory=memory,
+        )
+        labels = clusterer.fit_predict(embeddings_tSNE)
+        n_clusters = int(labels.max()) + 1
+
+        setting = ClusterSweep.Setting(
+            min_cluster_size=min_cluster_size,
+            min_samples=min_samples,
+            n_clusters=n_clusters,
+            noise_fraction=float((labels == -1).mean()),
+            persistence=float(clusterer.cluster_persistence_.mean())
+            if n_clusters
+            else 0.0,
+            validity=_validity(embeddings_tSNE, labels, validity_max_points)
+            if validity
+            else None,
+        )
+        result.append((setting, labels))
 
     return result
+
+
+def sweep_clusters(
+    embeddings_tSNE: npt.NDArray[np.float32],
+    min_cluster_sizes: list[int],
+    min_samples: list[int],
+    n_jobs: int = -1,
+    validity: bool = True,
+    validity_max_points: int = 2000,
+) -> tuple[ClusterSweep, dict[tuple[int, int], npt.NDArray[np.int64]]]:
+    """
+    Run hdbscan for every combination of min_cluster_sizes and min_samples, in parallel
+    across min_samples. Returns the metrics of each setting and its labels
+    """
+    click.echo("Sweeping hdbscan parameters on t-SNE embeddings")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        memory = joblib.Memory(cache_dir, verbose=0)
+        results = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_sweep_min_samples)(
+                embeddings_tSNE,
+                i,
+                sorted(min_cluster_sizes),
+                memory,
+                validity,
+                validity_max_points,
+            )
+            for i in min_samples
+        )
+
+    sweep = ClusterSweep(validity=validity)
+    labels: dict[tuple[int, int], npt.NDArray[np.int64]] = {}
+    for setting, setting_labels in (j for i in results for j in i):
+        sweep.settings.append(setting)
+        labels[setting.min_cluster_size, setting.min_samples] = setting_labels
+
+    return sweep, labels
@@ -9,6 +9,9 @@ envf.read_env(".env.local")
 
 class Env(pydantic.BaseModel):
     semantic_api_key: str = envf.str("SEMANTIC_SCHOLAR_API_KEY")
+    use_worker: bool = envf.bool("BIBLIO_USE_WORKER", True)
+    max_tokens: int | None = envf.int("BIBLIO_MAX_TOKENS", None)
+    max_cost: float | None = envf.float("BIBLIO_MAX_COST", None)
 
     class Path(pydantic.BaseModel):
         data: pathlib.Path = pathlib.Path(envf.str("DATA_PATH"))
@@ -17,10 +20,15 @@ class Env(pydantic.BaseModel):
         translations: pathlib.Path = data / "translations.json"
         cache_folder: pathlib.Path = data
         references: pathlib.Path = data / "references.json"
+        citations: pathlib.Path = data / "citations"
+        citation_analytics: pathlib.Path = data / "citation_analytics.json"
         clusters: pathlib.Path = data / "clusters.json"
         clusters_html: pathlib.Path = output / "clusters.html"
+        cluster_sweep: pathlib.Path = data / "cluster_sweep.json"
         threat_scores: pathlib.Path = data / "threat_scores.json"
+        threat_calibration: pathlib.Path = data / "threat_calibration.json"
         graph: pathlib.Path = output / "graph.png"
+        worker_socket: pathlib.Path = data / "worker.sock"
 
     path: Path = Path()
 
@@ -1,8 +1,10 @@
 import textwrap
 from typing import Any, Callable
-from .services.semantic_scholar import PaperID, References, ReferencesByPaper, Papers
 from .threat import ThreatScores
+from .citations import CitationGraph, get_cluster_labels
 
+import numpy as np
+import pydantic
 import networkx as nx
 
 from .clusters import Clusters, ClusterID
@@ -17,65 +19,57 @@ def median(lst: list[float]) -> float:
         return (lst[n // 2 - 1] + lst[n // 2]) / 2
 
 
-def filter_references_inside_papers(
-    papers: Papers, references: ReferencesByPaper
-) -> ReferencesByPaper:
+class ClusterLink(pydantic.BaseModel):
     """
-    Filter references to only be between between an element of papers and another element of papers
+    Summary of all citations from a cluster to another
     """
-    return ReferencesByPaper(
-        papers={
-            k: References(
-                references=[
-                    cit
-                    for cit in v.references
-                    if cit.citedPaper and cit.citedPaper.paperId in papers.papers
-                ]
-            )
-            for k, v in references.papers.items()
-        }
-    )
-
-
-def get_clusters_by_paper(clusters: Clusters) -> dict[PaperID, ClusterID]:
-    result: dict[PaperID, ClusterID] = {}
-    for cluster in clusters.clusters.values():
-        for point in cluster.points:
-            result[point.paper_id] = cluster.index
-
-    return result
 
+    n_references: int
+    n_cited: int
+    influential: bool
 
-def get_references_between_clusters(
-    references: ReferencesByPaper, clusters_by_paper: dict[PaperID, ClusterID]
-):
-    result: dict[tuple[ClusterID, ClusterID], list[References.Reference]] = {}
 
-    for src, links in references.papers.items():
-        for link in links.references:
-            assert link.citedPaper and link.citedPaper.paperId
+def get_links_between_clusters(
+    citations: CitationGraph, clusters: Clusters
+) -> dict[tuple[ClusterID, ClusterID], ClusterLink]:
+    labels = get_cluster_labels(citations, clusters)
+    src = labels[citations.sources]
+    trg = labels[citations.indices]
+    influential = citations.is_influential
 
-            trg = link.citedPaper.paperId
+    mask = (src != -1) & (trg != -1)
+    if not mask.any():
+        return {}
 
-            if src not in clusters_by_paper or trg not in clusters_by_paper:
-                continue
-
-            srcClass = clusters_by_paper[src]
-            trgClass = clusters_by_paper[trg]
-
-            if srcClass == -1 or trgClass == -1:
-                continue
-
-            result.setdefault((srcClass, trgClass), []).append(link)
+    src, trg, cited, influential = (
+        src[mask],
+        trg[mask],
+        np.asarray(citations.indices)[mask],
+        influential[mask],
+    )
 
-    return result
+    pairs, inverse, n_references = np.unique(
+        np.stack([src, trg]), axis=1, return_inverse=True, return_counts=True
+    )
+    inverse = inverse.reshape(-1)
+    any_influential = np.bincount(
+        inverse, weights=influential, minlength=pairs.shape[1]
+    )
+    unique_cited = np.unique(np.stack([inverse, cited]), axis=1)[0]
+    n_cited = np.bincount(unique_cited, minlength=pairs.shape[1])
+
+    return {
+        (int(pairs[0, i]), int(pairs[1, i])): ClusterLink(
+            n_references=int(n_references[i]),
+            n_cited=int(n_cited[i]),
+            influential=bool(any_influential[i] > 0),
+        )
+        for i in range(pairs.shape[1])
+    }
 
 
-def default_keep(references: list[References.Reference]):
-    return (
-        any(i.isInfluential for i in references)
-        or len({i.citedPaper.paperId for i in references if i.citedPaper}) >= 3
-    )
+def default_keep(link: ClusterLink):
+    return link.influential or link.n_cited >= 3
 
 
 default_palette = {
@@ -87,48 +81,36 @@ default_palette = {
 }
 
 
-def default_width_line(
-    references: list[References.Reference], influential_width_line: int = 8
-):
-    allTrgs = {i.citedPaper.paperId for i in references if i.citedPaper}
-
-    influential = any(i.isInfluential for i in references)
+def default_width_line(link: ClusterLink, influential_width_line: int = 8):
     return (
-        min(len(allTrgs), influential_width_line) / 2
-        if not influential
+        min(link.n_cited, influential_width_line) / 2
+        if not link.influential
         else influential_width_line
     )
 
 
 def generate_graph(
-    references_by_papers: ReferencesByPaper,
-    papers: Papers,
+    citations: CitationGraph,
     clusters: Clusters,
     threats: ThreatScores,
-    keep_function: Callable[[list[References.Reference]], bool] = default_keep,
-    width_line_function: Callable[
-        [list[References.Reference]], float
-    ] = default_width_line,
+    keep_function: Callable[[ClusterLink], bool] = default_keep,
+    width_line_function: Callable[[ClusterLink], float] = default_width_line,
     palette: dict[str, str] = default_palette,
     threshold_threat_color: float = 0.75,
     remove_isolated_nodes: bool = True,
     influence_weight: float | None = 1.0 / 8,
 ) -> nx.DiGraph:
-    references_by_papers = filter_references_inside_papers(papers, references_by_papers)
-    clusters_by_papers = get_clusters_by_paper(clusters)
-    references_between_clusters = get_references_between_clusters(
-        references_by_papers, clusters_by_papers
-    )
+    links_between_clusters = get_links_between_clusters(citations, clusters)
 
     def keep(edge: tuple[ClusterID, ClusterID]) -> bool:
         if edge[0] == edge[1]:
             return False
 
-        references = references_between_clusters.get(edge)
-        if not references:
+        link = links_between_clusters.get(edge)
+        if not link:
             return False
 
-        return keep_function(references)
+        return keep_function(link)
 
     clusters_num = clusters.clusters.keys()
     clusters_num = [
@@ -142,15 +124,14 @@ def generate_graph(
     graph = nx.DiGraph()
     graph.add_nodes_from(clusters_num)
 
-    for (src, trg), references in references_between_clusters.items():
+    for src, trg in links_between_clusters:
         if src in clusters_num and trg in clusters_num and keep((src, trg)):
-            graph.add_edge(src, trg, data=references)
+            graph.add_edge(src, trg)
 
     def get_edge_attrs(edge: tuple[ClusterID, ClusterID]) -> dict[str, Any]:
         return dict(
-            penwidth=width_line_function(references_between_clusters[edge]),
-            weight=width_line_function(references_between_clusters[edge])
-            * influence_weight
+            penwidth=width_line_function(links_between_clusters[edge]),
+            weight=width_line_function(links_between_clusters[edge]) * influence_weight
             if influence_weight
             else 1.0,
         )
@@ -4,13 +4,14 @@ import pydantic
 
 from langdetect import DetectorFactory, detect_langs
 from langdetect.lang_detect_exception import LangDetectException
-import nltk
 
 from .services import semantic_scholar
-from .services.openai import client
+from .services.openai import chat
+from .budget import Estimate, chunk_sentences, count_tokens
 
 DetectorFactory.seed = 0
-nltk.download("punkt")
+
+TRANSLATION_MODEL = "gpt-3.5-turbo"
 
 
 def is_text_in_language(text: str, language: str) -> bool:
@@ -34,29 +35,68 @@ class Translations(pydantic.BaseModel):
     translations: dict[PaperID, Translation]
 
 
-def translate_paper_to_en(
-    paper: semantic_scholar.Papers.Paper,
-) -> Translations.Translation:
+def _translation_prompts(
+    paper: semantic_scholar.Papers.Paper, max_abstract_tokens: int
+) -> tuple[list[str], str]:
     if not paper.abstract:
         raise ValueError("Paper does not have an abstract")
 
-    prompt = (
-        f"Translate or extract an English version of this abstract : '{paper.abstract}'"
-    )
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.0,
+    abstract_prompts = [
+        f"Translate or extract an English version of this abstract : '{chunk}'"
+        for chunk in chunk_sentences(
+            paper.abstract, max_abstract_tokens, TRANSLATION_MODEL
+        )
+    ]
+    title_prompt = f"Translate this title in English : '{paper.title}'"
+
+    return abstract_prompts, title_prompt
+
+
+def _expected_translation_tokens(prompt: str) -> int:
+    # Translations are about as long as the original text, with some slack. Only used
+    # for the budget, count_tokens may be an approximation too low to cap completions
+    return count_tokens(prompt, TRANSLATION_MODEL) * 3 // 2 + 16
+
+
+def estimate_translations(
+    papers: list[semantic_scholar.Papers.Paper], max_abstract_tokens: int = 1000
+) -> Estimate:
+    result = Estimate(model=TRANSLATION_MODEL)
+    for paper in papers:
+        abstract_prompts, title_prompt = _translation_prompts(
+            paper, max_abstract_tokens
+        )
+        for prompt in abstract_prompts + [title_prompt]:
+            result.add(prompt, _expected_translation_tokens(prompt))
+
+    return result
+
+
+def translate_paper_to_en(
+    paper: semantic_scholar.Papers.Paper,
+    max_abstract_tokens: int = 1000,
+) -> Translations.Translation:
+    """
+    Abstracts longer than max_abstract_tokens are translated by chunks of sentences
+    """
+    abstract_prompts, title_prompt = _translation_prompts(paper, max_abstract_tokens)
+
+    translated_abstract = " ".join(
+        chat(
+            prompt,
+            model=TRANSLATION_MODEL,
+            expected_tokens=_expected_translation_tokens(prompt),
+            temperature=0.0,
+        )
+        for prompt in abstract_prompts
     )
-    translated_abstract = response.choices[0].message.content or ""
 
-    prompt = f"Translate this title in English : '{paper.title}'"
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
+    translated_title = chat(
+        title_prompt,
+        model=TRANSLATION_MODEL,
+        expected_tokens=_expected_translation_tokens(title_prompt),
         temperature=0.0,
     )
-    translated_title = response.choices[0].message.content or ""
 
     return Translations.Translation(
         abstract=translated_abstract,
@@ -1,3 +1,48 @@
-from openai import OpenAI
+from typing import Any
+
+import click
+from openai import NOT_GIVEN, OpenAI
+
+from ..budget import budget, count_tokens, cost, MESSAGE_OVERHEAD
 
 client = OpenAI()
+
+
+def chat(
+    prompt: str,
+    model: str,
+    max_tokens: int | None = None,
+    expected_tokens: int | None = None,
+    **kwargs: Any,
+) -> str:
+    """
+    Single user message completion, checked against and charged to the global budget.
+    Without max_tokens, the completion is not capped and is checked as expected_tokens
+    """
+    completion_tokens = max_tokens if max_tokens is not None else expected_tokens or 0
+    prompt_tokens = count_tokens(prompt, model) + MESSAGE_OVERHEAD
+    budget.check(
+        prompt_tokens + completion_tokens,
+        cost(model, prompt_tokens, completion_tokens),
+        f"A {model} call",
+    )
+
+    response = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens if max_tokens is not None else NOT_GIVEN,
+        **kwargs,
+    )
+    if response.usage:
+        budget.charge(
+            model, response.usage.prompt_tokens, response.usage.completion_tokens
+        )
+
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        click.echo(
+            f"Warning: a {model} completion was cut at its maximum length",
+            err=True,
+        )
+
+    return choice.message.content or ""
@@ -1,4 +1,4 @@
-from typing import Iterable
+from typing import Iterable, Iterator
 import pydantic
 
 from semanticscholar.SemanticScholarException import NoMorePagesException
@@ -66,6 +66,8 @@ class References(pydantic.BaseModel):
         isInfluential: bool
 
     references: list[Reference]
+    # False when fetched through the batch endpoint, without isInfluential nor intents
+    detailed: bool = True
 
 
 class ReferencesByPaper(pydantic.BaseModel):
@@ -94,3 +96,51 @@ def fetch_references(
             break
 
     return References(references=result_raw)
+
+
+def fetch_references_batch(
+    paper_ids: Iterable[PaperID],
+    batch_size: int = 500,
+    limit: int = 100,
+) -> Iterator[tuple[PaperID, References]]:
+    """
+    Fetch references of many papers at once through the paper/batch endpoint.
+
+    The batch endpoint does not return isInfluential nor intents, so references
+    fetched this way are never influential, have no intents and are marked as not
+    detailed. Papers whose reference list comes back truncated are fetched again
+    with fetch_references.
+    """
+    paper_ids = list(paper_ids)
+    for start in range(0, len(paper_ids), batch_size):
+        batch = paper_ids[start : start + batch_size]
+        res = sch.get_papers(
+            paper_ids=batch,
+            fields=["paperId", "referenceCount", "references.paperId"],
+        )
+        assert isinstance(res, list)
+
+        found = {paper.paperId: paper.raw_data for paper in res}
+        for paper_id in batch:
+            data = found.get(paper_id)
+            references = (data or {}).get("references") or []
+            if data is None or len(references) < (data.get("referenceCount") or 0):
+                yield paper_id, fetch_references(paper_id=paper_id, limit=limit)
+                continue
+
+            yield (
+                paper_id,
+                References(
+                    references=[
+                        References.Reference(
+                            citedPaper=References.Reference.PaperRef(
+                                paperId=reference.get("paperId")
+                            ),
+                            intents=[],
+                            isInfluential=False,
+                        )
+                        for reference in references
+                    ],
+                    detailed=False,
+                ),
+            )
@@ -1,10 +1,19 @@
-from .clusters import ClusterID
+from .clusters import Clusters, ClusterID, get_embedder
 
 import pydantic
 
+import random
 import re
+from typing import Iterable
 
-from .services.openai import client
+import click
+import numpy as np
+import numpy.typing as npt
+from tqdm import tqdm
+from sentence_transformers import SentenceTransformer
+
+from .services.openai import chat
+from .budget import budget, Estimate
 
 
 # TODO: Should be refactored to use function calls so that threat_scores axes can be easily modified, and that it is overall more robust
@@ -20,8 +29,14 @@ class ThreatScores(pydantic.BaseModel):
     threat_scores: dict[ClusterID, ThreatScore] = {}
 
 
-def threat_score(label: str) -> ThreatScores.ThreatScore:
-    prompt = f"""
+# Could be gpt-4o, is faster and cheaper, but results are less consistent with gpt-4o, and gpt-4-turbo has higher variance
+THREAT_SCORE_MODEL = "gpt-4-turbo"
+# Ten lines of about 35 tokens, with room for a preamble since truncated answers lose experts
+THREAT_SCORE_MAX_TOKENS = 1000
+
+
+def threat_score_prompt(label: str) -> str:
+    return f"""
     Imagine a panel of ten experts in the research axis '{label}', each evaluating how directly their research axis contributes to mitigating bioterrorist threats on a scale from 0 to 1, where 0 indicates no direct contribution and 1 indicates a direct and substantial contribution to reducing the threat.
 
     Research Axis: '{label}'
@@ -41,15 +56,23 @@ def threat_score(label: str) -> ThreatScores.ThreatScore:
     ...
     Expert 10: Viral - X, Bacterial - X, Toxin - X, Fungal - X, Prion - X
     """
-    response = (
-        client.chat.completions.create(
-            model="gpt-4-turbo",  # Could be gpt-4o, is faster and cheaper, but results are less consistent with gpt-4o, and gpt-4-turbo has higher variance
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.0,
-            stop=["\n\n"],
-        )
-        .choices[0]
-        .message.content
+
+
+def estimate_threat_scores(labels: Iterable[str]) -> Estimate:
+    result = Estimate(model=THREAT_SCORE_MODEL)
+    for label in labels:
+        result.add(threat_score_prompt(label), THREAT_SCORE_MAX_TOKENS)
+
+    return result
+
+
+def threat_score(label: str) -> ThreatScores.ThreatScore:
+    response = chat(
+        threat_score_prompt(label),
+        model=THREAT_SCORE_MODEL,
+        max_tokens=THREAT_SCORE_MAX_TOKENS,
+        temperature=0.0,
+        stop=["\n\n"],
     )
     assert response
 
@@ -64,3 +87,160 @@ def threat_score(label: str) -> ThreatScores.ThreatScore:
             lst.append(float(match.group(i)))
 
     return result
+
+
+# Descriptions of research directly contributing to each axis of ThreatScores.ThreatScore,
+# compared with the abstracts embeddings of each cluster
+PROTOTYPES: dict[str, list[str]] = {
+    "prion": [
+        "Detection, decontamination and treatment of prion diseases and transmissible spongiform encephalopathies.",
+        "Misfolded prion protein propagation, inactivation and diagnosis of Creutzfeldt-Jakob disease and bovine spongiform encephalopathy.",
+    ],
+    "viral": [
+        "Detection, vaccines and antiviral therapeutics against smallpox, Ebola, hemorrhagic fever and other viral biothreat agents.",
+        "Surveillance and rapid diagnosis of outbreaks caused by weaponizable viruses.",
+    ],
+    "bacterial": [
+        "Detection, vaccines and antibiotic treatment against anthrax, plague, tularemia and other bacterial biothreat agents.",
+        "Rapid identification and decontamination of Bacillus anthracis spores and Yersinia pestis.",
+    ],
+    "toxin": [
+        "Detection, antitoxins and medical countermeasures against ricin, botulinum neurotoxin and other biological toxins.",
+        "Mechanisms, diagnosis and treatment of poisoning by toxins used as biological weapons.",
+    ],
+    "fungal": [
+        "Detection and treatment of pathogenic fungi and mycotoxins used against humans, crops or livestock.",
+        "Antifungal countermeasures and surveillance of fungal agents threatening agriculture and public health.",
+    ],
+}
+
+
+class ThreatCalibration(pydantic.BaseModel):
+    """
+    Linear mapping from the similarity of a paper to an axis prototype to a threat score
+    """
+
+    class Axis(pydantic.BaseModel):
+        # Not fitted: maps a cosine similarity of 0.1 to 0 and of 0.5 to 1, the usual
+        # range of all-mpnet-base-v2 similarities between an abstract and a description
+        # of an unrelated or of the same topic. Only meant until a calibration is run
+        slope: float = 2.5
+        intercept: float = -0.25
+
+    axes: dict[str, Axis] = pydantic.Field(
+        default_factory=lambda: {
+            i: ThreatCalibration.Axis() for i in ThreatScores.ThreatScore.model_fields
+        }
+    )
+
+
+def embed_prototypes(embedder: SentenceTransformer) -> npt.NDArray[np.float32]:
+    """
+    Mean normalized embedding of the prototypes of each axis, in ThreatScore field order
+    """
+    prototypes = []
+    for axis in ThreatScores.ThreatScore.model_fields:
+        embeddings = embedder.encode(PROTOTYPES[axis], normalize_embeddings=True)
+        mean = np.asarray(embeddings).mean(axis=0)
+        prototypes.append(mean / np.linalg.norm(mean))
+
+    return np.stack(prototypes)
+
+
+def prototype_similarities(
+    clusters: Clusters, embedder: SentenceTransformer | None = None
+) -> dict[ClusterID, npt.NDArray[np.float32]]:
+    """
+    Cosine similarity of every paper of each cluster to each axis, shape (papers, axes)
+    """
+    prototypes = embed_prototypes(embedder or get_embedder())
+
+    ids = list(clusters.clusters)
+    embeddings = np.array(
+        [p.embedding for i in ids for p in clusters.clusters[i].points],
+        dtype=np.float32,
+    ).reshape(-1, prototypes.shape[1])
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True).clip(1e-12)
+    similarities = embeddings @ prototypes.T
+
+    sizes = [len(clusters.clusters[i].points) for i in ids]
+    return dict(zip(ids, np.split(similarities, np.cumsum(sizes)[:-1])))
+
+
+def local_threat_scores(
+    clusters: Clusters,
+    calibration: ThreatCalibration | None = None,
+    embedder: SentenceTransformer | None = None,
+) -> ThreatScores:
+    """
+    Score every cluster without any LLM call, each paper of a cluster acting as an expert
+    """
+    calibration = calibration or ThreatCalibration()
+    axes = list(ThreatScores.ThreatScore.model_fields)
+    slopes = np.array([calibration.axes[i].slope for i in axes])
+    intercepts = np.array([calibration.axes[i].intercept for i in axes])
+
+    result = ThreatScores()
+    for cluster, similarities in prototype_similarities(clusters, embedder).items():
+        scores = np.clip(similarities * slopes + intercepts, 0.0, 1.0)
+        result.threat_scores[cluster] = ThreatScores.ThreatScore(
+            **{axis: scores[:, i].round(3).tolist() for i, axis in enumerate(axes)}
+        )
+
+    return result
+
+
+# Fewer LLM scored clusters give fits dominated by noise
+MIN_CALIBRATION_CLUSTERS = 5
+
+
+def calibrate(
+    clusters: Clusters,
+    sample_size: int = 10,
+    seed: int = 0,
+    embedder: SentenceTransformer | None = None,
+) -> ThreatCalibration:
+    """
+    Fit the calibration of each axis on the LLM scores of a sample of clusters. Axes
+    with a non positive fitted slope, which would invert scores, keep the defaults
+    """
+    similarities = prototype_similarities(clusters, embedder)
+    candidates = [i for i in clusters.clusters if i != -1]
+    sample = random.Random(seed).sample(candidates, min(sample_size, len(candidates)))
+
+    if len(sample) < MIN_CALIBRATION_CLUSTERS:
+        raise click.ClickException(
+            f"Calibrating threat scores needs at least {MIN_CALIBRATION_CLUSTERS} "
+            f"clusters, got {len(sample)}"
+        )
+
+    budget.check_estimates(
+        [estimate_threat_scores(clusters.clusters[i].name for i in sample)],
+        "Calibrating threat scores",
+    )
+    llm_scores = {
+        i: threat_score(clusters.clusters[i].name)
+        for i in tqdm(sample, desc="Evaluating threat scores for calibration")
+    }
+
+    result = ThreatCalibration()
+
+    for index, axis in enumerate(ThreatScores.ThreatScore.model_fields):
+        x = np.array([np.median(similarities[i][:, index]) for i in sample])
+        y = np.array([np.median(getattr(llm_scores[i], axis) or [0.0]) for i in sample])
+        if np.ptp(x) == 0:
+            continue
+
+        slope, intercept = np.polyfit(x, y, 1)
+        if slope <= 0:
+            click.echo(
+                f"Warning: calibration of {axis} has slope {slope:.3f}, using defaults",
+                err=True,
+            )
+            continue
+
+        result.axes[axis] = ThreatCalibration.Axis(
+            slope=float(slope), intercept=float(intercept)
+        )
+
+    return result
@@ -0,0 +1,131 @@
+import base64
+import colorsys
+from typing import Any, Iterator
+
+import click
+import numpy as np
+import numpy.typing as npt
+
+from .clusters import Clusters
+
+# Golden ratio conjugate, successive hues stay far apart however many are drawn
+HUE_STEP = 0.618033988749895
+
+
+def generate_colors() -> Iterator[str]:
+    """
+    Endless sequence of distinct hex colors
+    """
+    hue = 0.0
+    lightnesses = (0.5, 0.35, 0.65)
+    index = 0
+    while True:
+        r, g, b = colorsys.hls_to_rgb(hue, lightnesses[index % 3], 0.75)
+        yield f"#{int(r * 255):02x}{int(g * 255):02x}{int(b * 255):02x}"
+        hue = (hue + HUE_STEP) % 1.0
+        index += 1
+
+
+def packed(array: npt.NDArray[Any]) -> dict[str, str]:
+    """
+    Plotly.js typed array, embedded as base64 instead of a JSON list of numbers
+    """
+    array = np.ascontiguousarray(array)
+    dtype = {
+        np.dtype(np.float32): "f4",
+        np.dtype(np.uint8): "u1",
+        np.dtype(np.uint16): "u2",
+        np.dtype(np.uint32): "u4",
+    }[array.dtype]
+    return {"dtype": dtype, "bdata": base64.b64encode(array.tobytes()).decode()}
+
+
+def decimate(
+    labels: npt.NDArray[np.int64], max_points: int, min_per_cluster: int = 50
+) -> npt.NDArray[np.int64]:
+    """
+    Indices of at most about max_points points, sampled uniformly inside each cluster
+    so that small clusters keep at least min_per_cluster points
+    """
+    if len(labels) <= max_points:
+        return np.arange(len(labels))
+
+    rng = np.random.default_rng(0)
+    ratio = max_points / len(labels)
+    _, counts = np.unique(labels, return_counts=True)
+    kept = []
+    by_cluster = np.split(np.argsort(labels, kind="stable"), np.cumsum(counts)[:-1])
+    for members in by_cluster:
+        n_kept = min(len(members), max(min_per_cluster, int(len(members) * ratio)))
+        kept.append(rng.choice(members, size=n_kept, replace=False))
+
+    return np.sort(np.concatenate(kept))
+
+
+def large_clusters_figure(clusters: Clusters, max_points: int) -> dict[str, Any]:
+    """
+    Single WebGL trace for all clusters, colored by cluster, with a label at the
+    centroid of each cluster instead of a legend
+    """
+    kept_clusters = [i for i in clusters.clusters.values() if i.index != -1]
+    n_dims = len(next((p.tsne for i in kept_clusters for p in i.points), (0.0,) * 3))
+    if n_dims < 3:
+        raise click.ClickException(
+            f"A 3d figure needs at least 3 t-SNE dimensions, got {n_dims}"
+        )
+
+    tsne = np.array(
+        [p.tsne for i in kept_clusters for p in i.points], dtype=np.float32
+    ).reshape(-1, n_dims)[:, :3]
+    labels = np.repeat(
+        np.arange(len(kept_clusters)), [len(i.points) for i in kept_clusters]
+    )
+
+    kept = decimate(labels, max_points)
+    tsne, labels = tsne[kept], labels[kept]
+
+    n_colors = max(len(kept_clusters), 1)
+    colors = generate_colors()
+    colorscale = [
+        [bound, color]
+        for i, color in zip(range(n_colors), colors)
+        for bound in (i / n_colors, (i + 1) / n_colors)
+    ]
+
+    centroids = [
+        np.asarray([p.tsne[:3] for p in i.points]).mean(axis=0) for i in kept_clusters
+    ]
+
+    return dict(
+        data=[
+            dict(
+                type="scatter3d",
+                x=packed(tsne[:, 0]),
+                y=packed(tsne[:, 1]),
+                z=packed(tsne[:, 2]),
+                mode="markers",
+                marker=dict(
+                    size=2,
+                    opacity=0.8,
+                    color=packed(labels.astype(np.uint32)),
+                    colorscale=colorscale,
+                    cmin=-0.5,
+                    cmax=n_colors - 0.5,
+                ),
+                hoverinfo="skip",
+                showlegend=False,
+            ),
+            dict(
+                type="scatter3d",
+                x=[float(i[0]) for i in centroids],
+                y=[float(i[1]) for i in centroids],
+                z=[float(i[2]) for i in centroids],
+                mode="markers",
+                marker=dict(size=4, color="black"),
+                hovertext=[i.name for i in kept_clusters],
+                hoverinfo="text",
+                showlegend=False,
+            ),
+        ],
+        layout=dict(margin=dict(l=0, r=0, t=0, b=0)),
+    )
@@ -0,0 +1,267 @@
+"""
+Long running process keeping models, caches and clients loaded between commands.
+
+The biblio entry point only imports this module before forwarding its arguments
+to a running worker, so that torch, sklearn and hdbscan are imported once by the
+worker instead of by every command.
+
+The worker listens on a Unix socket only readable by its user, in the data folder.
+Requests and responses are JSON lines: the caller sends its arguments, working
+directory and a digest of its environment, the worker streams back the output of
+the command and ends with its exit code.
+"""
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from typing import IO, Any
+
+import click
+
+from .env import env
+
+# Variables read once when the worker starts, commands are refused when the caller
+# has different values
+ENVIRONMENT = (
+    "DATA_PATH",
+    "OUTPUT_PATH",
+    "OPENAI_API_KEY",
+    "SEMANTIC_SCHOLAR_API_KEY",
+    "BIBLIO_MAX_TOKENS",
+    "BIBLIO_MAX_COST",
+)
+
+
+def environment_digest() -> dict[str, str]:
+    return {
+        name: hashlib.sha256(os.environ.get(name, "").encode()).hexdigest()
+        for name in ENVIRONMENT
+    }
+
+
+class _Stream(io.TextIOBase):
+    """
+    Sends everything written to it to the caller, shared by all threads of the
+    command. Writing once the caller is gone aborts the command
+    """
+
+    encoding = "utf-8"
+
+    def __init__(self, handler: "_Handler", name: str):
+        self.handler = handler
+        self.name = name
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        if text:
+            self.handler.send({"stream": self.name, "text": text})
+        return len(text)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "_Server"
+
+    def setup(self):
+        super().setup()
+        self.lock = threading.Lock()
+        self.connected = True
+
+    def send(self, message: dict[str, Any]):
+        """
+        Raises click.Abort when the caller is gone, so that a command interrupted in
+        the client stops instead of running to the end
+        """
+        with self.lock:
+            if not self.connected:
+                raise click.Abort()
+            try:
+                self.wfile.write(json.dumps(message).encode() + b"\n")
+                self.wfile.flush()
+            except OSError:
+                self.connected = False
+                raise click.Abort()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+
+        try:
+            with (
+                contextlib.redirect_stdout(_Stream(self, "stdout")),
+                contextlib.redirect_stderr(_Stream(self, "stderr")),
+            ):
+                exit_code = self.execute(request)
+
+            self.send({"exit_code": exit_code})
+        except click.Abort:
+            click.echo(f"Aborted {' '.join(request['args'])}, its caller is gone")
+
+    def execute(self, request: dict[str, Any]) -> int:
+        different = [
+            name
+            for name, digest in self.server.environment.items()
+            if request["environment"].get(name) != digest
+        ]
+        if different:
+            click.echo(
+                f"Error: The worker was started with a different {', '.join(different)}, "
+                "restart it or set BIBLIO_USE_WORKER=false",
+                err=True,
+            )
+            return 1
+
+        try:
+            with contextlib.chdir(request["cwd"]):
+                return run(self.server.cli, request["args"])
+        except OSError as e:
+            click.echo(f"Error: {e}", err=True)
+            return 1
+
+
+class _Server(socketserver.UnixStreamServer):
+    # Callers wait in the socket backlog while a command is running
+    request_queue_size = 64
+
+    def __init__(self, cli: click.Group, path: pathlib.Path):
+        self.cli = cli
+        self.path = path
+        self.environment = environment_digest()
+
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(path), _Handler)
+        finally:
+            os.umask(umask)
+        path.chmod(0o600)
+
+    def server_close(self):
+        super().server_close()
+        self.path.unlink(missing_ok=True)
+
+
+def run(cli: click.Group, args: list[str]) -> int:
+    """
+    Run a command in the current process, returning its exit code
+    """
+    try:
+        cli.main(args=args, prog_name="biblio", standalone_mode=False)
+        return 0
+    except click.exceptions.Exit as e:
+        return e.exit_code
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        click.echo("Aborted!", err=True)
+        return 1
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            return e.code or 0
+        click.echo(e.code, err=True)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+def serve(cli: click.Group, path: pathlib.Path):
+    """
+    Commands are executed one at a time, in the order they are received, in the
+    working directory of their caller
+    """
+    path = path.absolute()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if connect(path) is not None:
+        raise click.ClickException(f"A worker is already listening on {path}")
+    path.unlink(missing_ok=True)
+
+    server = _Server(cli, path)
+    click.echo(f"Worker listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def connect(path: pathlib.Path) -> socket.socket | None:
+    """
+    None if no worker is listening on path
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(str(path))
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+    except OSError as e:
+        client.close()
+        raise click.ClickException(f"Cannot connect to the worker on {path}: {e}")
+
+    return client
+
+
+def forward(args: list[str], path: pathlib.Path) -> int | None:
+    """
+    Run a command on the worker and print its output as it comes, returns its exit
+    code or None if no worker is running
+    """
+    client = connect(path)
+    if client is None:
+        return None
+
+    request = {
+        "args": args,
+        "cwd": os.getcwd(),
+        "environment": environment_digest(),
+    }
+    outputs: dict[str, IO[str]] = {"stdout": sys.stdout, "stderr": sys.stderr}
+    with client, client.makefile("rwb") as stream:
+        try:
+            stream.write(json.dumps(request).encode() + b"\n")
+            stream.flush()
+            for line in stream:
+                message = json.loads(line)
+                if "exit_code" in message:
+                    return message["exit_code"]
+                outputs[message["stream"]].write(message["text"])
+                outputs[message["stream"]].flush()
+        except OSError:
+            pass
+
+    raise click.ClickException("The worker stopped before the end of the command")
+
+
+def main():
+    args = sys.argv[1:]
+    if env.use_worker and args[:1] != ["worker"]:
+        try:
+            exit_code = forward(args, env.path.worker_socket)
+        except click.ClickException as e:
+            e.show()
+            sys.exit(e.exit_code)
+        except KeyboardInterrupt:
+            click.echo("Aborted!", err=True)
+            sys.exit(1)
+
+        if exit_code is not None:
+            sys.exit(exit_code)
+
+    from .__main__ import cli
+
+    cli()